@@ -18,6 +18,8 @@ class PageItem(scrapy.Item):
 
     # 抓取/解析附加信息（你的 pipeline/输出里已出现过）
     checksum = scrapy.Field()     # 去重/签名
+    raw_checksum = scrapy.Field() # 原始 HTML 指纹（蜘蛛写盘时计算）
+    raw_body = scrapy.Field()     # 原始 HTML 字节：供 pipeline 回退抽取，免去读盘；不写入 JSONL
     license = scrapy.Field()      # 版权（若有）
     robots = scrapy.Field()       # robots 提示（若有）
     outlinks = scrapy.Field()     # list[str]：外链（若收集）
@@ -1,41 +1,230 @@
 # crawler/pipelines.py
-import os, sqlite3, hashlib, orjson, time, tldextract
+import os, sqlite3, orjson, time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from langdetect import detect
+from urllib.parse import urlsplit
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from pybloom_live import ScalableBloomFilter
 from trafilatura import extract
+from twisted.internet import defer, task
 from scrapy.exceptions import DropItem
 from itemadapter import ItemAdapter  # 方便安全地读/写 Item 字段
+from .utils import fingerprint
 
 DB_PATH = "db/crawl.sqlite"
 TEXT_DIR = Path("data/text")
 RAW_DIR = Path("data/raw")
 
+# SQLite 批量提交：攒够 FLUSH_EVERY 个 item 或每隔 FLUSH_INTERVAL 秒落盘一次
+FLUSH_EVERY = 500
+FLUSH_INTERVAL = 2.0
+# 内容去重的 Bloom 过滤器：命中才去查 SQLite，未命中即可确定是新内容
+BLOOM_CAPACITY = 1_000_000
+BLOOM_ERROR_RATE = 1e-3
+# 语言检测只看正文开头，足够判定且避免对长文逐字打分
+LANG_DETECT_CHARS = 2000
+# 语言检测/内容指纹放到进程池里算，reactor 线程只管调度下载
+POOL_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+)
+
+# 去重表：只按主键点查，用 WITHOUT ROWID 省掉 rowid 与主键索引之间的一层间接
+DEDUP_TABLES = {
+    "seen": ("url TEXT PRIMARY KEY, checksum TEXT, fetched_at REAL", "url"),
+    # 用“文本内容”的 checksum 做内容去重索引
+    "text_index": ("checksum TEXT PRIMARY KEY, url TEXT, title TEXT, lang TEXT", "checksum"),
+}
+
+
+# ---------- 进程池 worker ----------
+# 每个 worker 进程只加载一次语言画像
+_worker_ldf = None
+
+
+def _init_worker():
+    global _worker_ldf
+    _worker_ldf = DetectorFactory()
+    _worker_ldf.load_profile(PROFILES_DIRECTORY)
+
+
+def _detect_and_hash(text: str):
+    """在 worker 进程里执行：返回 (lang, 内容 checksum)。"""
+    try:
+        det = _worker_ldf.create()
+        det.append(text[:LANG_DETECT_CHARS])
+        lang = det.detect()
+    except Exception:
+        lang = "und"
+    return lang, fingerprint(text.encode("utf-8"))
+
+
+def _deferred_from_future(fut):
+    """concurrent.futures.Future -> 在 reactor 线程里触发的 Deferred。"""
+    # 用时再取 reactor：模块级 import 会抢先装上默认 reactor，和 Scrapy 的 TWISTED_REACTOR 冲突
+    from twisted.internet import reactor
+    d = defer.Deferred()
+
+    def _fire(f):
+        try:
+            result = f.result()
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+    fut.add_done_callback(lambda f: reactor.callFromThread(_fire, f))
+    return d
+
+
 class DedupeAndStorePipeline:
     def open_spider(self, spider):
         Path("db").mkdir(exist_ok=True, parents=True)
         TEXT_DIR.mkdir(exist_ok=True, parents=True)
         RAW_DIR.mkdir(exist_ok=True, parents=True)
-        self.conn = sqlite3.connect(DB_PATH)
-        self.conn.execute("""CREATE TABLE IF NOT EXISTS seen(
-            url TEXT PRIMARY KEY, checksum TEXT, fetched_at REAL)""")
-        # 用“文本内容”的 checksum 做内容去重索引
-        self.conn.execute("""CREATE TABLE IF NOT EXISTS text_index(
-            checksum TEXT PRIMARY KEY, url TEXT, title TEXT, lang TEXT)""")
-        self.conn.commit()
+        # 自动提交模式，事务由 _flush() 显式 BEGIN/COMMIT 控制
+        self.conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        for pragma in SQLITE_PRAGMAS:
+            self.conn.execute(pragma)
+        for name, (cols, pk) in DEDUP_TABLES.items():
+            self._ensure_table(name, cols, pk)
+
+        # URL 去重集合常驻内存（含尚未落盘的部分），SQLite 只负责持久化
+        self._seen_urls = {row[0] for row in self.conn.execute("SELECT url FROM seen")}
+        # 内容 checksum 只进 Bloom 过滤器（约 10 bit/条），“可能重复”时再以 SQLite 为准
+        self._bloom = ScalableBloomFilter(initial_capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE)
+        for (checksum,) in self.conn.execute("SELECT checksum FROM text_index"):
+            self._bloom.add(checksum)
+
+        # 尚未落盘的写入；_pending_checksums 供去重时查看未提交的部分
+        self._pending_seen = []
+        self._pending_text = []
+        self._pending_checksums = set()
+
+        # 语言检测 + 内容指纹的进程池（worker 启动时各自加载一次语言画像）
+        # 显式用 spawn：reactor 进程里有线程，fork 不安全；各平台（含 Windows）行为一致
+        try:
+            self._pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, initializer=_init_worker,
+                                             mp_context=mp.get_context("spawn"))
+        except (OSError, ValueError, NotImplementedError) as e:
+            spider.logger.warning("进程池不可用，改在本进程内做语言检测: %s", e)
+            self._pool = None
+            _init_worker()
+
+        # item 类 -> (有 checksum 字段, 有 raw_checksum 字段)
+        self._fields_by_cls = {}
+
+        # domain -> 已打开的 JSONL 句柄，整个爬取期间复用
+        self._fh = {}
+        self._logger = spider.logger
+        self._flush_task = task.LoopingCall(self._flush)
+        self._start_flush_task()
+
+    def _start_flush_task(self):
+        self._flush_task.start(FLUSH_INTERVAL, now=False).addErrback(self._flush_task_failed)
+
+    def _flush_task_failed(self, failure):
+        # LoopingCall 抛一次异常就停表；记日志后重启，未提交的行留在 _pending_* 里下一轮重试
+        self._logger.error("定时落盘失败，稍后重试: %s", failure.getErrorMessage())
+        self._start_flush_task()
+
+    def _ensure_table(self, name, cols, pk):
+        """建表（WITHOUT ROWID）；旧库里的普通 rowid 表就地迁移成 WITHOUT ROWID。"""
+        row = self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()
+        if row is None:
+            self.conn.execute(f"CREATE TABLE {name}({cols}) WITHOUT ROWID")
+            return
+        if "WITHOUT ROWID" in row[0].upper():
+            return
+        # 迁移：新建 → 拷数据（主键为 NULL 的脏行丢掉，WITHOUT ROWID 不允许）→ 替换
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute(f"CREATE TABLE {name}_new({cols}) WITHOUT ROWID")
+            self.conn.execute(
+                f"INSERT OR IGNORE INTO {name}_new SELECT * FROM {name} WHERE {pk} IS NOT NULL")
+            self.conn.execute(f"DROP TABLE {name}")
+            self.conn.execute(f"ALTER TABLE {name}_new RENAME TO {name}")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
 
     def close_spider(self, spider):
+        if self._flush_task.running:
+            self._flush_task.stop()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._flush()
         self.conn.close()
+        for fh in self._fh.values():
+            fh.close()
+        self._fh.clear()
+
+    def _jsonl_handle(self, dom):
+        fh = self._fh.get(dom)
+        if fh is None:
+            fh = self._fh[dom] = open(TEXT_DIR / f"{dom}.jsonl", "ab", buffering=1 << 20)
+        return fh
+
+    def _flush(self):
+        """把攒下的 seen / text_index 写入放进一个事务提交。"""
+        if not self._pending_seen and not self._pending_text:
+            return
+        # 先把 JSONL 缓冲写出，避免 seen 已提交而正文还留在缓冲里
+        for fh in self._fh.values():
+            fh.flush()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO text_index(checksum, url, title, lang) VALUES (?,?,?,?)",
+                self._pending_text
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO seen(url, checksum, fetched_at) VALUES (?,?,?)",
+                self._pending_seen
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self._pending_seen = []
+        self._pending_text = []
+        self._pending_checksums.clear()
+
+    def _maybe_flush(self):
+        # 每个要落盘的 item（保留或判重丢弃）都恰好记一行 seen，按它计数即按 item 计数
+        if len(self._pending_seen) >= FLUSH_EVERY:
+            self._flush()
+
+    def _field_flags(self, item):
+        cls = type(item)
+        flags = self._fields_by_cls.get(cls)
+        if flags is None:
+            fields = getattr(cls, "fields", {})
+            flags = self._fields_by_cls[cls] = ("checksum" in fields, "raw_checksum" in fields)
+        return flags
 
     def _seen(self, url):
-        cur = self.conn.execute("SELECT 1 FROM seen WHERE url=?", (url,))
+        return url in self._seen_urls
+
+    def _seen_content(self, checksum):
+        if checksum not in self._bloom:
+            return False
+        if checksum in self._pending_checksums:
+            return True
+        cur = self.conn.execute("SELECT 1 FROM text_index WHERE checksum=?", (checksum,))
         return cur.fetchone() is not None
 
     def _mark_seen(self, url, checksum):
-        self.conn.execute(
-            "INSERT OR REPLACE INTO seen(url, checksum, fetched_at) VALUES (?,?,?)",
-            (url, checksum, time.time())
-        )
-        self.conn.commit()
+        self._pending_seen.append((url, checksum, time.time()))
+        self._seen_urls.add(url)
+        self._maybe_flush()
 
     def process_item(self, item, spider):
         adapter = ItemAdapter(item)
@@ -47,106 +236,139 @@ class DedupeAndStorePipeline:
         if self._seen(url):
             raise DropItem("dup-url")
 
-        # 2) 读取原始 HTML（用于回退抽取 & 生成原始校验）
-        html_path = adapter.get("html_path")
-        raw = b""
-        if html_path and os.path.exists(html_path):
-            with open(html_path, "rb") as f:
-                raw = f.read()
-        raw_checksum = hashlib.sha1(raw).hexdigest() if raw else None
+        # 2) 原始校验优先用蜘蛛写盘时算好的 raw_checksum；
+        #    raw_body 是蜘蛛随 item 带来的原始 HTML（只在本 pipeline 内使用，不随 item 往后传）
+        raw_checksum = adapter.get("raw_checksum")
+        raw = adapter.pop("raw_body", None) or b""
 
         # 3) 选择“要保存的文本”
         #    优先用蜘蛛给的 text_lines / bodytext / text，最后才回退 trafilatura
-        text = None
+        text = ""
         lines = adapter.get("text_lines") or adapter.get("bodytext")
-        if lines and isinstance(lines, (list, tuple)):
-            text = "\n".join(str(x) for x in lines).strip()
+        if isinstance(lines, (list, tuple)):
+            try:
+                text = "\n".join(lines)             # 常见情况：元素都是 str，免去逐个 str()
+            except TypeError:
+                text = "\n".join(map(str, lines))
+            text = text.strip()
 
         if not text:
             t = adapter.get("text")
             if isinstance(t, (bytes, bytearray)):
-                try:
-                    t = t.decode("utf-8", "ignore")
-                except Exception:
-                    t = str(t)
+                t = t.decode("utf-8", "ignore")
             text = (t or "").strip()
 
         if not text:
-            # 回退：从原始 HTML 里抽
+            # 回退：按拼接、strip 后的文本判断（纯空白 / [""] 也算没给），从原始 HTML 里抽；
+            # 蜘蛛没带 raw_body 时才重新读盘
+            html_path = adapter.get("html_path")
+            if not raw and html_path and os.path.exists(html_path):
+                with open(html_path, "rb") as f:
+                    raw = f.read()
             if raw:
                 try:
-                    text = extract(raw.decode("utf-8", errors="ignore"),
-                                   include_links=False, include_images=False) or ""
+                    text = (extract(raw.decode("utf-8", errors="ignore"),
+                                    include_links=False, include_images=False) or "").strip()
                 except Exception:
                     text = ""
-            else:
-                text = ""
+        if raw and not raw_checksum:
+            raw_checksum = fingerprint(raw)
 
         # 4) 文本长度检查（过短丢弃）
-        if len(text.strip()) < 20:
+        if len(text) < 20:
             # 仍然把 URL 标记为已见，避免重复抓
             self._mark_seen(url, raw_checksum or "")
             raise DropItem("short")
 
-        # 5) 语言检测
-        try:
-            lang = detect(text)
-        except Exception:
-            lang = "und"
+        # 5) 语言检测 + 6) 内容级 checksum（基于文本内容）交给进程池，
+        #    算完回到 reactor 线程里再做去重与落盘
+        d = self._detect(text)
+        d.addCallback(self._store, adapter, url, text, raw_checksum)
+        return d
+
+    def _detect(self, text):
+        """进程池可用就丢给池子；池子起不来/已损坏则回退到本进程内计算。"""
+        if self._pool is not None:
+            try:
+                d = _deferred_from_future(self._pool.submit(_detect_and_hash, text))
+            except BrokenProcessPool:
+                self._drop_pool()
+            else:
+                d.addErrback(self._detect_inline, text)
+                return d
+        return defer.succeed(_detect_and_hash(text))
+
+    def _detect_inline(self, failure, text):
+        failure.trap(BrokenProcessPool)
+        self._drop_pool()
+        return _detect_and_hash(text)
 
+    def _drop_pool(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        if _worker_ldf is None:
+            _init_worker()
+
+    def _store(self, result, adapter, url, text, raw_checksum):
+        lang, checksum = result
         adapter["lang"] = lang  # 这行安全，即使 item 未定义该字段也不会报错（ItemAdapter 兜底）
 
-        # 6) 内容级 checksum（基于文本内容）
-        checksum = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        # 进程池计算期间，同一 URL 可能已经被另一个 item 处理完
+        if self._seen(url):
+            raise DropItem("dup-url")
 
         # 7) 内容去重：相同文本就视为重复
-        cur = self.conn.execute("SELECT 1 FROM text_index WHERE checksum=?", (checksum,))
-        if cur.fetchone():
+        if self._seen_content(checksum):
             self._mark_seen(url, raw_checksum or checksum)
             raise DropItem("dup-content")
 
         # 8) 回写 item（尽量不破坏蜘蛛的原始字段；若字段不存在也不会抛错）
         adapter["text"] = text
-        # 如果 item 支持这些字段，再写入
-        if "checksum" in getattr(adapter.item, "fields", {}):
+        # 如果 item 支持这些字段，再写入（按 item 类缓存字段判断，不必每条都查 fields）
+        has_checksum, has_raw_checksum = self._field_flags(adapter.item)
+        if has_checksum:
             adapter["checksum"] = checksum
-        if "raw_checksum" in getattr(adapter.item, "fields", {}):
+        if has_raw_checksum:
             adapter["raw_checksum"] = raw_checksum
 
         # 9) 组织输出 JSON（一并输出 bodytext/text_lines，便于你核对）
+        #    scrapy.Item 的值就存在 _values 里，直接读省掉 ItemAdapter 的逐字段分派
+        vals = getattr(adapter.item, "_values", None)
+        if vals is None:
+            vals = adapter
         out = {
             "url": url,
-            "domain": adapter.get("domain"),
-            "fetched_at": adapter.get("fetched_at"),
-            "status": adapter.get("status"),
-            "content_type": adapter.get("content_type"),
-            "title": adapter.get("title"),
+            "domain": vals.get("domain"),
+            "fetched_at": vals.get("fetched_at"),
+            "status": vals.get("status"),
+            "content_type": vals.get("content_type"),
+            "title": vals.get("title"),
             "lang": lang,
             "text": text,
             "checksum": checksum,
-            "license": adapter.get("license"),
-            "robots": adapter.get("robots"),
-            "outlinks": adapter.get("outlinks", []) or [],
-            "meta": adapter.get("meta"),
-            "bearers": adapter.get("bearers"),
+            "license": vals.get("license"),
+            "robots": vals.get("robots"),
+            "outlinks": vals.get("outlinks") or [],
+            "meta": vals.get("meta"),
+            "bearers": vals.get("bearers"),
             # 新增两个辅助观测字段（若 spider 有给的话）
-            "bodytext": adapter.get("bodytext"),
-            "text_lines": adapter.get("text_lines"),
+            "bodytext": vals.get("bodytext"),
+            "text_lines": vals.get("text_lines"),
         }
 
         # 10) 以 domain 归档写入 JSONL
-        dom = adapter.get("domain") or tldextract.extract(url).domain
-        path = TEXT_DIR / f"{dom}.jsonl"
-        with open(path, "ab") as fw:
-            fw.write(orjson.dumps(out) + b"\n")
-
-        # 11) 写入内容索引
-        self.conn.execute(
-            "INSERT OR REPLACE INTO text_index(checksum, url, title, lang) VALUES (?,?,?,?)",
-            (checksum, url, adapter.get("title"), lang)
-        )
-        self.conn.commit()
+        dom = out["domain"]
+        if not dom:
+            # 蜘蛛一般都会给 domain；兜底直接取主机名，不再走 tldextract 的 PSL 查询
+            dom = urlsplit(url).hostname or "unknown"
+        self._jsonl_handle(dom).write(orjson.dumps(out, option=orjson.OPT_APPEND_NEWLINE))
+
+        # 11) 写入内容索引（随 seen 一起批量提交）
+        self._pending_text.append((checksum, url, out["title"], lang))
+        self._pending_checksums.add(checksum)
+        self._bloom.add(checksum)
 
         # 12) 标记 URL 已见（记录原始校验或内容校验）
         self._mark_seen(url, raw_checksum or checksum)
-        return item
+        return adapter.item
@@ -1,10 +1,18 @@
 import re
 import time
+import threading
+import orjson
+from queue import SimpleQueue
+from functools import lru_cache
+from urllib.parse import urlsplit
 import scrapy
 import tldextract
 from pathlib import Path
-from w3lib.html import remove_tags
+from lxml.etree import XPath
+from parsel import Selector, SelectorList
+from parsel.csstranslator import HTMLTranslator
 from ..items import PageItem
+from ..utils import fingerprint
 
 
 META_KEYS = [
@@ -19,6 +27,88 @@ BEARER_KEYS = [
 ]
 BEARER_KEYS_SET = set(BEARER_KEYS)
 
+# 可读文本块的输出顺序：与表格标签顺序一致；未列出的键按原顺序追加在后
+META_ORDER = tuple(META_KEYS)
+BEARER_ORDER = tuple(BEARER_KEYS)
+# 这几项已合并进“姓名：…（性别：…，民族：…，出生日期：…）”，不再单独输出
+BEARER_HEAD_KEYS = ("姓名", "性别", "民族", "出生日期")
+BEARER_REST_ORDER = tuple(k for k in BEARER_ORDER if k not in BEARER_HEAD_KEYS)
+
+
+def _clean(v) -> str:
+    """空值 -> ""；str 直接 strip，其他类型才转 str。"""
+    if not v:
+        return ""
+    return v.strip() if isinstance(v, str) else str(v).strip()
+
+
+# ---------- 预编译选择器 ----------
+# CSS 在模块加载时一次性翻译成 XPath 并交给 lxml 编译，避免每个页面重复翻译/编译
+_css2xpath = HTMLTranslator().css_to_xpath
+
+def _xp(css: str) -> XPath:
+    return XPath(_css2xpath(css))
+
+_XP_BODY = _xp(".inherit_xx1, .inherit_xx2")
+_XP_BODY_OLD = _xp(".inherit_xx1 .text")
+_XP_BODY_CANDS = tuple(_xp(css) for css in (
+    ".text", ".project_content", ".projectContent",
+    ".article .content", ".details .text", ".details .content",
+    ".container .content", ".content"
+))
+_XP_MAIN = _xp(
+    ".project_detail, .project-details, .projectDetails, "
+    ".details, .article, .content, .project_content, .container"
+)
+_XP_TABLES = _xp("table")
+_XP_TEXT = _xp(".text")
+_XP_P = _xp(".p")
+_XP_TITLE_TEXT = XPath(_css2xpath("title") + "/text()")
+# 标题候选一次遍历全取回，再按 h1 > og:title > <title> 的优先级挑（不能直接取 [1]：
+# 文档顺序里 <head> 的 og:title/<title> 总在 <h1> 前面）
+_XP_TITLE_CANDS = XPath("//h1/text() | //meta[@property='og:title']/@content | //title/text()")
+_XP_PUB_TIME = _xp("time::text, .date::text, .pubtime::text")
+
+_RE_404_TITLE = re.compile(r"\b404\b|未找到|不存在|页面走丢|Not\s*Found", re.I)
+_RE_404_HEAD = re.compile(r"404|页面不存在|对不起|未找到|Not Found", re.I)
+
+
+def _select(sel, xp: XPath) -> SelectorList:
+    """在 Response / Selector / SelectorList 上执行预编译 XPath，结果包回 SelectorList。"""
+    sel = getattr(sel, "selector", sel)  # Response -> Selector
+    sels = sel if isinstance(sel, SelectorList) else [sel]
+    return SelectorList(Selector(root=node, type="html") for s in sels for node in xp(s.root))
+
+
+def _pick_title(root) -> str:
+    first = {}
+    for s in _XP_TITLE_CANDS(root):
+        # 属性/首段文本的 getparent() 即 h1 / meta / title；
+        # 子元素后面的文本（<h1><a>Site</a> Real Title</h1>）是 tail，getparent() 是那个子元素
+        owner = s.getparent().getparent() if s.is_tail else s.getparent()
+        first.setdefault(owner.tag, s)
+    return first.get("h1") or first.get("meta") or first.get("title") or ""
+
+
+@lru_cache(maxsize=1024)
+def _registered_domain(netloc: str) -> str:
+    """按主机名缓存 tldextract 结果：同一站点只做一次 PSL 查询。"""
+    ext = tldextract.extract(netloc)
+    return f"{ext.domain}.{ext.suffix}"
+
+
+def _iter_text_with_breaks(el):
+    """按文档顺序产出 el 下的全部文本，<br> 处产出换行；跳过注释/处理指令本身的文本。"""
+    if el.text:
+        yield el.text
+    for child in el:
+        if child.tag == "br":
+            yield "\n"
+        elif isinstance(child.tag, str):
+            yield from _iter_text_with_breaks(child)
+        if child.tail:
+            yield child.tail
+
 
 class FocusedSpider(scrapy.Spider):
     name = "focused"
@@ -47,12 +137,6 @@ class FocusedSpider(scrapy.Spider):
         self.enrich_format = (enrich_format or "readable").lower()
         self.add_json_summary = str(add_json_summary).strip() in ("1","true","yes","on")
 
-        # 常量
-        self.META_ORDER = ["项目序号", "项目编号", "公布时间", "类别", "所属地区", "类型", "申报地区或单位", "保护单位"]
-        self.BEARER_ORDER = ["编号", "姓名", "性别", "出生日期", "民族", "类别", "项目编号", "项目名称",
-                             "申报地区或单位"]
-        self.RULER = "\n\n——\n\n"
-
         # 预编译……
         label_alt = "|".join(map(re.escape, META_KEYS))
         self.meta_kv_regex = re.compile(rf"({label_alt})\s*[：:]\s*")
@@ -60,27 +144,39 @@ class FocusedSpider(scrapy.Spider):
         bearer_label_alt = "|".join(map(re.escape, BEARER_KEYS))
         self.bearer_prefix_regex = re.compile(rf"^({bearer_label_alt})\s*[：:\u3000 ]*")
 
+        # 原始 HTML 落盘：目录只建一次；写文件交给后台线程，不占 reactor
+        self._raw_dirs = set()
+        self._raw_q = SimpleQueue()
+        self._raw_writer = threading.Thread(target=self._write_raw_loop, name="raw-html-writer", daemon=True)
+        self._raw_writer.start()
+
+    def _write_raw_loop(self):
+        while True:
+            path, body = self._raw_q.get()
+            if path is None:
+                return
+            try:
+                path.write_bytes(body)
+            except OSError as e:
+                self.logger.warning("write raw html failed: %s (%s)", path, e)
+
+    def closed(self, reason):
+        # 等后台线程把队列里剩下的原始 HTML 写完
+        self._raw_q.put((None, None))
+        self._raw_writer.join()
+
         # ---------- NEW: 可读文本块 ----------
     def _block_meta_readable(self, meta: dict) -> str:
             if not isinstance(meta, dict) or not meta:
                 return ""
-            order = ["项目序号", "项目编号", "公布时间", "公布批次", "批次",
-                     "类别", "所属地区", "类型", "申报地区或单位", "保护单位"]
-            lines = []
-            for k in order:
-                v = meta.get(k)
-                if v and str(v).strip():
-                    lines.append(f"{k}：{str(v).strip()}")
+            lines = [f"{k}：{c}" for k in META_ORDER if (c := _clean(meta.get(k)))]
             # 其余键追加
-            for k, v in meta.items():
-                if k not in order and v and str(v).strip():
-                    lines.append(f"{k}：{str(v).strip()}")
+            lines += [f"{k}：{c}" for k, v in meta.items() if k not in META_KEYS_SET and (c := _clean(v))]
             return "【项目基本信息】\n" + "\n".join(lines) if lines else ""
 
     def _block_bearers_readable(self, bearers: list) -> str:
             if not isinstance(bearers, list) or not bearers:
                 return ""
-            order = ["编号", "姓名", "性别", "出生日期", "民族", "类别", "项目编号", "项目名称", "申报地区或单位"]
             lines = []
             for b in bearers:
                 if not isinstance(b, dict):
@@ -99,18 +195,9 @@ class FocusedSpider(scrapy.Spider):
                     if attrs:
                         s += "（" + "，".join(attrs) + "）"
                     head.append(s)
-                for k in order:
-                    if k in ("姓名", "性别", "民族", "出生日期"):
-                        continue
-                    v = b.get(k)
-                    if v and str(v).strip():
-                        head.append(f"{k}：{str(v).strip()}")
+                head += [f"{k}：{c}" for k in BEARER_REST_ORDER if (c := _clean(b.get(k)))]
                 # 额外键
-                for k, v in b.items():
-                    if k in order:
-                        continue
-                    if v and str(v).strip():
-                        head.append(f"{k}：{str(v).strip()}")
+                head += [f"{k}：{c}" for k, v in b.items() if k not in BEARER_KEYS_SET and (c := _clean(v))]
                 if head:
                     lines.append("- " + "；".join(head))
             return "【代表性传承人】\n" + "\n".join(lines) if lines else ""
@@ -119,54 +206,60 @@ class FocusedSpider(scrapy.Spider):
     def _block_meta_json(self, meta: dict) -> str:
             if not isinstance(meta, dict) or not meta:
                 return ""
-            import json
-            return "【项目基本信息-JSON】\n" + json.dumps(meta, ensure_ascii=False)
+            return "【项目基本信息-JSON】\n" + orjson.dumps(meta).decode()
 
     def _block_bearers_json(self, bearers: list) -> str:
             if not isinstance(bearers, list) or not bearers:
                 return ""
-            import json
-            return "【代表性传承人-JSON】\n" + json.dumps(bearers, ensure_ascii=False)
+            return "【代表性传承人-JSON】\n" + orjson.dumps(bearers).decode()
 
     def _block_summary_json(self, meta: dict, bearers: list) -> str:
-            import json
             payload = {}
             if isinstance(meta, dict) and meta: payload["meta"] = meta
             if isinstance(bearers, list) and bearers: payload["bearers"] = bearers
-            return "【JSON摘要】\n" + json.dumps(payload, ensure_ascii=False) if payload else ""
+            return "【JSON摘要】\n" + orjson.dumps(payload).decode() if payload else ""
 
     # ---------------- 工具函数 ----------------
-    def _norm(self, s: str | None) -> str:
+    @staticmethod
+    def _norm(s: str | None) -> str:
         if not s:
             return ""
-        s = s.replace("\u3000", " ").replace("\xa0", " ")
+        # str.split() 本身就把 \u3000 / \xa0 视为空白，无需先 replace；
+        # split + join 全在 C 层完成，比逐字符扫描（含 Cython 版）更快
         return " ".join(s.split())
 
+    def _cell_text(self, cell) -> str:
+        # string(.) 由 lxml 在 C 层拼接全部后代文本，等价于 "*::text, ::text" 再 join
+        return self._norm(cell.xpath("string(.)").get())
+
     # —— 正文抽取 —— #
     def _pick_body_container(self, response, main_sel):
         # 同时抓 .inherit_xx1(.article-mod2) 与 .inherit_xx2
-        nodes = response.css(".inherit_xx1, .inherit_xx2")
+        nodes = _select(response, _XP_BODY)
         if nodes:
             return nodes  # SelectorList
         # 其次：老模板
-        container = response.css(".inherit_xx1 .text")
+        container = _select(response, _XP_BODY_OLD)
         if container:
             return container
-        cands = [
-            ".text", ".project_content", ".projectContent",
-            ".article .content", ".details .text", ".details .content",
-            ".container .content", ".content"
-        ]
-        for css in cands:
-            c = main_sel.css(css)
+        for xp in _XP_BODY_CANDS:
+            c = _select(main_sel, xp)
             if c:
                 return c
         return main_sel or response
 
-    def _html_to_lines(self, html: str) -> list[str]:
-        html = (html or "").replace("<br>", "\n").replace("<br/>", "\n").replace("<br />", "\n")
-        text = remove_tags(html)
-        return [self._norm(x) for x in text.splitlines() if self._norm(x)]
+    def _sel_lines(self, sel) -> list[str]:
+        """
+        取节点文本并按 <br> 断行：直接遍历已解析好的 lxml 树，
+        不再把节点序列化成 HTML 再 replace + remove_tags 二次处理。
+        """
+        if isinstance(sel, SelectorList):
+            sel = sel[0] if sel else None
+        root = getattr(getattr(sel, "selector", sel), "root", None)
+        if root is None or isinstance(root, str):
+            return []
+        lines = (self._norm(x) for x in "".join(_iter_text_with_breaks(root)).splitlines())
+        return [x for x in lines if x]
 
     def _extract_body_paragraphs(self, response, main_sel) -> list[str]:
         """
@@ -184,18 +277,17 @@ class FocusedSpider(scrapy.Spider):
         paras: list[str] = []
         for cont in it:
             # 兼容 .inherit_xx1.article-mod2 里可能还有 .text 包一层
-            c = cont.css(".text") or cont
+            c = _select(cont, _XP_TEXT) or cont
 
-            p_blocks = c.css(".p")
+            p_blocks = _select(c, _XP_P)
             if p_blocks:
                 for blk in p_blocks:
-                    lines = self._html_to_lines(blk.get() or "")
+                    lines = self._sel_lines(blk)
                     para = self._norm(" ".join(lines))  # 同段合并
                     if para:
                         paras.append(para)
             else:
-                html = c.get() if hasattr(c, "get") else (c or "")
-                paras.extend(self._html_to_lines(html))
+                paras.extend(self._sel_lines(c))
         return paras
 
     def _is_404_like(self, response):
@@ -203,12 +295,12 @@ class FocusedSpider(scrapy.Spider):
         if "/404.html" in response.url:
             return True
         # <title> 命中关键词
-        title = "".join(response.css("title::text").getall()).strip()
-        if re.search(r"\b404\b|未找到|不存在|页面走丢|Not\s*Found", title, re.I):
+        title = "".join(_XP_TITLE_TEXT(response.selector.root)).strip()
+        if _RE_404_TITLE.search(title):
             return True
         # 正文里也兜底扫一眼（有些站 title 也写正常）
         head = response.text[:2000]
-        if re.search(r"404|页面不存在|对不起|未找到|Not Found", head, re.I):
+        if _RE_404_HEAD.search(head):
             return True
         return False
 
@@ -218,18 +310,20 @@ class FocusedSpider(scrapy.Spider):
         情况A：一行多格，形如 [项目序号：, 283, 项目编号：, Ⅵ-1, ...]
         """
         out = {}
+        # 每格只剥一次冒号，后面“当前格是否为 key / 下一格是否为 key”都查这张表
+        keys = [c.rstrip("：:").strip() for c in cells]
+        n = len(cells)
         i = 0
-        while i < len(cells):
-            key_raw = cells[i].rstrip("：:").strip()
+        while i < n:
+            key_raw = keys[i]
             if key_raw in META_KEYS_SET:
-                val = cells[i + 1].strip() if i + 1 < len(cells) else ""
                 # 如果下一格仍是 key，则视为该 key 值缺失
-                nxt = cells[i + 1].rstrip("：:").strip() if i + 1 < len(cells) else ""
-                if nxt in META_KEYS_SET:
+                if i + 1 < n and keys[i + 1] not in META_KEYS_SET:
+                    val = cells[i + 1].strip()
+                    i += 2
+                else:
                     val = ""
                     i += 1
-                else:
-                    i += 2
                 out[key_raw] = self._norm(val)
                 continue
             i += 1
@@ -257,7 +351,7 @@ class FocusedSpider(scrapy.Spider):
         data = {}
         for tr in sel.css("tr"):
             # 每个格子独立取文本，便于“跨格成对”解析
-            cells = [self._norm("".join(td.css("*::text, ::text").getall())) for td in tr.css("th, td")]
+            cells = [self._cell_text(td) for td in tr.css("th, td")]
             cells = [c for c in cells if c]
             if not cells:
                 continue
@@ -298,29 +392,31 @@ class FocusedSpider(scrapy.Spider):
                 headers[i] = f"列{i+1}"
         return headers
 
-    def _table_rows(self, sel) -> list:
+    def _table_rows(self, trs) -> list:
+        """trs: 表格的全部 <tr>（调用方已遍历过一次，这里直接切片复用）。"""
         rows = []
-        # 先看看第一行是否是表头
-        first_tr = sel.css("tr:first-child")
-        header_cells = [self._norm("".join(c.css("*::text, ::text").getall()))
-                        for c in first_tr.css("th, td")]
-        header_cells = [h.replace("：", "").strip() for h in header_cells if self._norm(h)]
+        if not trs:
+            return rows
+        # 先看看第一行是否是表头；格子文本只取一遍，表头判断与列名推断共用
+        first_cells = [(c.root.tag, self._cell_text(c)) for c in trs[0].css("th, td")]
+        header_cells = [h.replace("：", "").strip() for _, h in first_cells if h]
 
-        headers = []
+        first_td_cells = None
         if header_cells and sum(1 for h in header_cells if h in BEARER_KEYS_SET) >= max(3, len(header_cells)//2):
             # 视作有效表头
             headers = header_cells
-            data_trs = sel.css("tr")[1:]
+            data_trs = trs[1:]
         else:
             # 没有表头：用第一行推断列名
-            data_trs = sel.css("tr")
-            if data_trs:
-                first_cells = [self._norm("".join(c.css("*::text, ::text").getall()))
-                               for c in data_trs[0].css("td")]
-                headers = self._derive_headers_from_first_row(first_cells)
-
-        for tr in data_trs:
-            cells = [self._norm("".join(c.css("*::text, ::text").getall())) for c in tr.css("td")]
+            data_trs = trs
+            first_td_cells = [t for tag, t in first_cells if tag == "td"]
+            headers = self._derive_headers_from_first_row(first_td_cells)
+
+        for n, tr in enumerate(data_trs):
+            if n == 0 and first_td_cells is not None:
+                cells = first_td_cells
+            else:
+                cells = [self._cell_text(c) for c in tr.css("td")]
             if not cells:
                 continue
             row = {}
@@ -351,40 +447,36 @@ class FocusedSpider(scrapy.Spider):
 
         # 保存原始 HTML
         ts = str(int(time.time()))
-        ext = tldextract.extract(response.url)
-        dom = f"{ext.domain}.{ext.suffix}"
+        dom = _registered_domain(urlsplit(response.url).netloc)
         raw_dir = Path("data/raw") / dom
-        raw_dir.mkdir(parents=True, exist_ok=True)
+        if dom not in self._raw_dirs:
+            raw_dir.mkdir(parents=True, exist_ok=True)
+            self._raw_dirs.add(dom)
         html_path = raw_dir / f"{ts}.html"
-        html_path.write_bytes(response.body)
+        body = response.body
+        self._raw_q.put((html_path, body))
+        raw_checksum = fingerprint(body)  # 趁内存里还有 body 顺手算，pipeline 不必再读盘
 
         # 标题/时间
-        title = (
-            response.css("h1::text").get()
-            or response.css("meta[property='og:title']::attr(content)").get()
-            or response.css("title::text").get()
-            or ""
-        )
-        title = self._norm(title)
-        pub_time = self._norm(response.css("time::text, .date::text, .pubtime::text").get() or "")
+        root = response.selector.root
+        title = self._norm(_pick_title(root))
+        pub_time = self._norm(next(iter(_XP_PUB_TIME(root)), ""))
 
         # 主体容器
-        main = response.css(
-            ".project_detail, .project-details, .projectDetails, "
-            ".details, .article, .content, .project_content, .container"
-        ) or response
+        main = _select(response, _XP_MAIN) or response
 
         # 基本信息 & 传承人
-        tables = main.css("table")
+        tables = _select(main, _XP_TABLES)
         meta = {}
         bearers = []
         if tables:
             meta = self._kv_table(tables[0]) if tables else {}
             # 其余表作为“传承人”候选
             for tb in tables[1:]:
-                header_text = " ".join(tb.css("tr:first-child *::text, tr:first-child::text").getall())
-                if any(k in header_text for k in BEARER_KEYS) or len(tb.css("tr")) >= 2:
-                    rows = self._table_rows(tb)
+                trs = tb.css("tr")
+                header_text = " ".join(trs[0].xpath(".//text()").getall()) if trs else ""
+                if any(k in header_text for k in BEARER_KEYS) or len(trs) >= 2:
+                    rows = self._table_rows(trs)
                     if rows:
                         bearers.extend(rows)
 
@@ -434,6 +526,10 @@ class FocusedSpider(scrapy.Spider):
         item["pub_time"] = pub_time
         item["text"] = text_clean          # 纯文本（含换行）
         item["html_path"] = str(html_path)
+        item["raw_checksum"] = raw_checksum
+        if not text_clean:
+            # 原始 HTML 由后台线程写盘，pipeline 此时未必读得到：直接随 item 带上供回退抽取
+            item["raw_body"] = body
         item["meta"] = meta
         item["bearers"] = bearers
         item["text_augmented"] = (self.enrich_mode in ("append", "replace"))  # NEW
@@ -1,29 +1,40 @@
 import scrapy, time, feedparser
 from pathlib import Path
+from urllib.parse import urlsplit
 from ..items import PageItem
+from ..utils import fingerprint
 
 class RSSSpider(scrapy.Spider):
     name = "rss"
     def start_requests(self):
+        # 订阅源本身也交给 Scrapy 下载器并发抓取，不在这里同步阻塞 reactor
         feeds = Path("seeds/rss.txt").read_text(encoding="utf-8").splitlines()
         for f in feeds:
             f = f.strip()
-            if not f:
+            if not f or f.startswith("#"):  # seeds/rss.txt 里允许注释行
                 continue
-            d = feedparser.parse(f)
-            for e in d.entries:
-                url = e.link
+            yield scrapy.Request(f, callback=self.parse_feed)
+
+    def parse_feed(self, response):
+        d = feedparser.parse(response.body)
+        for e in d.entries:
+            url = e.get("link")
+            if url:
                 yield scrapy.Request(url, callback=self.parse_article)
 
     def parse_article(self, response):
         item = PageItem()
         item["url"] = response.url
+        item["domain"] = urlsplit(response.url).hostname
         item["fetched_at"] = time.time()
         item["status"] = response.status
         item["content_type"] = response.headers.get("Content-Type", b"").decode("utf-8", "ignore")
         item["title"] = response.css("title::text").get() or ""
         p = Path("data/raw/rss"); p.mkdir(parents=True, exist_ok=True)
         html_path = p / f"{int(time.time()*1000)}.html"
-        html_path.write_bytes(response.body)
+        body = response.body
+        html_path.write_bytes(body)
         item["html_path"] = str(html_path)
+        item["raw_checksum"] = fingerprint(body)
+        item["raw_body"] = body  # 没有正文，pipeline 要靠它回退抽取
         yield item
@@ -0,0 +1,7 @@
+# crawler/utils.py
+import blake3
+
+
+def fingerprint(data: bytes) -> str:
+    """去重用指纹（非密码学用途）：BLAKE3 截到 20 字节，与原 SHA-1 hex 等宽。"""
+    return blake3.blake3(data).hexdigest(length=20)
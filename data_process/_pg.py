@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+_pg.py
+------
+ingest_jsonl_to_db / ingest_jsonl_to_polardb 共用的 PostgreSQL 连接。
+"""
+
+import os
+import psycopg2
+
+def connect():
+    """按 PG* 环境变量建立连接：手动事务，会话内关闭 synchronous_commit。"""
+    conn = psycopg2.connect(
+        host=os.environ.get("PGHOST", "localhost"),
+        port=int(os.environ.get("PGPORT", "5432")),
+        user=os.environ.get("PGUSER", "postgres"),
+        password=os.environ.get("PGPASSWORD", ""),
+        dbname=os.environ.get("PGDATABASE", "postgres"),
+    )
+    conn.autocommit = False
+    # 导入可重跑（幂等），不必每次提交都等 WAL 刷盘；
+    # 单独提交，调用方后面即使 rollback 也不会撤销这个会话设置
+    with conn.cursor() as cur:
+        cur.execute("SET synchronous_commit = off")
+    conn.commit()
+    return conn
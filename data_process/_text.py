@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+_text.py
+--------
+convert_to_documents_and_chunks / ingest_jsonl_to_db 共用的文本工具：
+断句切块（带原文下标）、稳定文档 id、chunk 内容哈希。两边必须一致，
+否则 convert 产出的 document_id 与入库时算出的 id、切块结果会对不上。
+另有共用的 JSONL 读取与 JSON 编解码（ingest_jsonl_to_polardb 也从这里导入）。
+"""
+
+import os, json, hashlib, mmap
+from contextlib import contextmanager
+from typing import List, Tuple
+
+IO_BUFFER = 16 * 1024 * 1024  # JSONL 读写缓冲，减少大文件的短读/短写 syscall
+
+# JSON 解析/序列化优先用 orjson（bytes 进出、直接 UTF-8），没装时退回标准库（json.loads 同样接受 bytes）
+try:
+    import orjson
+    loads = orjson.loads
+    dumps = orjson.dumps
+    def dump_line(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+except ImportError:
+    loads = json.loads
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    def dump_line(obj) -> bytes:
+        return dumps(obj) + b"\n"
+
+@contextmanager
+def open_jsonl(path, use_mmap: bool = False):
+    """打开 JSONL 供逐行读取（bytes）。默认走大缓冲读；use_mmap 时在只读内存映射上按行扫，冷盘大文件更省拷贝。"""
+    with open(path, "rb", buffering=IO_BUFFER) as f:
+        if not use_mmap or os.fstat(f.fileno()).st_size == 0:  # 空文件不能 mmap
+            yield f
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield iter(mm.readline, b"")
+
+def stable_id(obj: dict) -> int:
+    """优先用已有 id；没有就对 url 做64位hash生成稳定 id。"""
+    if "id" in obj and obj["id"] not in (None, ""):
+        try:
+            return int(obj["id"])
+        except Exception:
+            pass
+    url = (obj.get("url") or "").strip()
+    if not url:
+        # 无 url 时，退化到整条 json 的 md5 前 16 位
+        h = hashlib.md5(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    else:
+        h = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return int(h, 16) & ((1<<63)-1)  # 压到 64bit
+
+def content_hash(b: bytes) -> str:
+    """chunks.content_md5 的取值：blake2b 16 字节摘要（32 位 hex，与 md5 同宽），只作幂等键。"""
+    return hashlib.blake2b(b, digest_size=16).hexdigest()
+
+# 简单中文断句切块（可按需替换为更精细的 token 切块）
+# 粗略断句：连续空行视作段落边界，其余句末标点逐个 str.replace 成哨兵后一次 split；
+# 全程不走正则（str.translate 对非 ASCII 走慢路径，反而更慢）
+SENT_MARKS = ("。", "；", "！", "？", "?")
+SENTINEL = "\x1f"
+
+def split_sentences(text: str) -> List[Tuple[str, int, int]]:
+    """断句，返回 (句子, 原文起点, 原文终点)。"""
+    # "\n\n" 成对等长替换，下标与原文一致；奇数个换行剩下的那个 "\n" 落在句首，会被 strip 掉
+    text = text.replace("\n\n", SENTINEL * 2)
+    for m in SENT_MARKS:
+        text = text.replace(m, SENTINEL)
+    out, pos = [], 0
+    for p in text.split(SENTINEL):
+        q = p.strip()
+        if q:
+            start = pos + len(p) - len(p.lstrip())
+            out.append((q, start, start + len(q)))
+        pos += len(p) + 1
+    return out
+
+def split_text_with_offsets(text: str, max_chars=1000, min_chars=600) -> List[Tuple[str, int, int]]:
+    """
+    切块并返回 (块, char_start, char_end)。
+    块由若干句以空格拼成，起点取首句起点、终点取末句终点，无需再回原文 find。
+    """
+    if not text:
+        return []
+    parts = split_sentences(text)
+    chunks, buf, bstart, bend = [], "", 0, 0
+    for p, start, end in parts:
+        if len(buf) + len(p) + 1 <= max_chars:
+            if buf:
+                buf = (buf + " " + p).strip()
+            else:
+                buf, bstart = p, start
+            bend = end
+        else:
+            if buf: chunks.append((buf, bstart, bend))
+            buf, bstart, bend = p, start, end
+    if buf: chunks.append((buf, bstart, bend))
+    # 合并过短块
+    merged = []
+    for c, start, end in chunks:
+        if merged and len(c) < min_chars and len(merged[-1][0]) + len(c) + 1 <= int(max_chars*1.5):
+            prev = merged[-1]
+            merged[-1] = ((prev[0] + " " + c).strip(), prev[1], end)
+        else:
+            merged.append((c, start, end))
+    return merged
+
+def split_text(text: str, max_chars=1000, min_chars=600) -> List[str]:
+    return [c for c, _, _ in split_text_with_offsets(text, max_chars, min_chars)]
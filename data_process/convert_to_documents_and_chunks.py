@@ -9,36 +9,27 @@
 默认路径已按你的项目设置，如需修改，改下面 CONFIG 部分即可。
 """
 
-import sys, json, re, argparse, hashlib, datetime
+import os, sys, json, argparse, datetime
+import multiprocessing as mp
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 
+from _text import split_text_with_offsets, stable_id, IO_BUFFER, open_jsonl, loads, dump_line
+
 # ========== CONFIG（按需修改） ==========
 BASE = Path(r"C:\Users\Dell\Desktop\heritage_crawl")
 INPUT_JSONL = BASE / r"data\text\ihchina.cn.jsonl"             # 你的清晰版 JSONL（改成你的文件名）
 OUT_DOC = BASE / r"data\text\documents_min.jsonl"                 # 输出 documents
 OUT_CH = BASE / r"data\text\chunks.jsonl"                         # 输出 chunks
 KEEP_EXTRA_JSON = False                                            # 是否把 meta/bearers 放到 documents.extra_json
+WORKERS = os.cpu_count() or 1                                      # 解析/切块的进程数；1 = 不开进程池
+USE_MMAP = False                                                   # 输入改走 mmap 按行扫（冷盘大文件）
 # ========== CONFIG END ==========
 
-SPLIT_PAT = re.compile(r"(?:\n{2,}|。|；|！|\?|？)")  # 粗略断句
 MAX_CHARS = 1000
 MIN_CHARS = 600
 
-def stable_id(obj):
-    """优先用已有 id；没有就对 url 做64位hash生成稳定 id。"""
-    if "id" in obj and obj["id"] not in (None, ""):
-        try:
-            return int(obj["id"])
-        except Exception:
-            pass
-    url = (obj.get("url") or "").strip()
-    if not url:
-        # 无 url 时，退化到整条 json 的 md5 前 16 位
-        h = hashlib.md5(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
-    else:
-        h = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
-    return int(h, 16) & ((1<<63)-1)  # 压到 64bit
-
 def to_iso(ts):
     """将 epoch 秒/毫秒转换为 ISO8601；非数值返回 None。"""
     if ts is None:
@@ -51,29 +42,61 @@ def to_iso(ts):
     except Exception:
         return None
 
-def split_text(text):
-    if not text:
-        return []
-    parts = [p.strip() for p in SPLIT_PAT.split(text) if p.strip()]
-    chunks = []
-    buf = ""
-    for p in parts:
-        if len(buf) + len(p) + 1 <= MAX_CHARS:
-            buf = (buf + " " + p).strip() if buf else p
-        else:
-            if buf: chunks.append(buf)
-            buf = p
-    if buf: chunks.append(buf)
-    # 合并过短块
-    merged = []
-    for c in chunks:
-        if merged and len(c) < MIN_CHARS and len(merged[-1]) + len(c) + 1 <= int(MAX_CHARS*1.5):
-            merged[-1] = (merged[-1] + " " + c).strip()
-        else:
-            merged.append(c)
-    return merged
-
-def convert(input_path: Path, out_doc: Path, out_ch: Path, keep_extra_json: bool = True):
+def _process_line(line, keep_extra_json=True):
+    """
+    单行 JSON -> (documents 行 bytes, chunks 行 bytes, chunk 数)；空行/坏行返回 None。
+    纯函数，供进程池并行调用。
+    """
+    if line.isspace():  # 不 strip，省一次整行复制
+        return None
+    try:
+        obj = loads(line)
+    except Exception:
+        return None
+
+    doc_id = stable_id(obj)
+    url = obj.get("url") or ""
+    title = obj.get("title") or ""
+    lang = obj.get("lang") or ""
+    domain = obj.get("domain") or ""
+    text = obj.get("text") or ""
+    fetched_at_iso = obj.get("fetched_at_iso") or to_iso(obj.get("fetched_at"))
+
+    # documents_min.jsonl 的一行
+    doc_rec = {
+        "id": doc_id,
+        "url": url,
+        "title": title,
+        "lang": lang,
+        "domain": domain,
+        "fetched_at_iso": fetched_at_iso,
+        "text": text
+    }
+    if keep_extra_json:
+        extra = {}
+        if isinstance(obj.get("meta"), dict) and obj.get("meta"):
+            extra["meta"] = obj["meta"]
+        if isinstance(obj.get("bearers"), list) and obj.get("bearers"):
+            extra["bearers"] = obj["bearers"]
+        if extra:
+            doc_rec["extra_json"] = extra
+
+    # 切分 text -> chunks.jsonl 的若干行
+    produced = split_text_with_offsets(text, MAX_CHARS, MIN_CHARS)
+    ch_lines = []
+    for idx, (piece, start, end) in enumerate(produced):
+        ch_rec = {
+            "document_id": doc_id,
+            "chunk_index": idx,
+            "content": piece,
+            "char_start": start,
+            "char_end": end
+        }
+        ch_lines.append(dump_line(ch_rec))
+    return dump_line(doc_rec), b"".join(ch_lines), len(ch_lines)
+
+def convert(input_path: Path, out_doc: Path, out_ch: Path, keep_extra_json: bool = True, workers: int = WORKERS,
+            use_mmap: bool = USE_MMAP):
     input_path = Path(input_path)
     out_doc = Path(out_doc)
     out_ch = Path(out_ch)
@@ -86,67 +109,24 @@ def convert(input_path: Path, out_doc: Path, out_ch: Path, keep_extra_json: bool
 
     total_docs = 0
     total_chunks = 0
-
-    with open(input_path, "r", encoding="utf-8") as fin, \
-         open(out_doc, "w", encoding="utf-8") as docs_out, \
-         open(out_ch, "w", encoding="utf-8") as ch_out:
-
-        for line in fin:
-            if not line.strip():
+    work = partial(_process_line, keep_extra_json=keep_extra_json)
+
+    # Pool 的 with 退出时 terminate：出错/中断时不会卡在 join 上等 worker 跑完剩余任务
+    with (mp.Pool(workers) if workers > 1 else nullcontext()) as pool, \
+         open_jsonl(input_path, use_mmap) as fin, \
+         open(out_doc, "wb", buffering=IO_BUFFER) as docs_out, \
+         open(out_ch, "wb", buffering=IO_BUFFER) as ch_out:
+
+        # 解析与切块在子进程里做，主进程只顺序写盘；imap 保序，输出与单进程逐字节一致
+        results = pool.imap(work, fin, chunksize=256) if pool else map(work, fin)
+        for res in results:
+            if res is None:
                 continue
-            try:
-                obj = json.loads(line)
-            except Exception:
-                continue
-
-            doc_id = stable_id(obj)
-            url = obj.get("url") or ""
-            title = obj.get("title") or ""
-            lang = obj.get("lang") or ""
-            domain = obj.get("domain") or ""
-            text = obj.get("text") or ""
-            fetched_at_iso = obj.get("fetched_at_iso") or to_iso(obj.get("fetched_at"))
-
-            # 写 documents_min.jsonl
-            doc_rec = {
-                "id": doc_id,
-                "url": url,
-                "title": title,
-                "lang": lang,
-                "domain": domain,
-                "fetched_at_iso": fetched_at_iso,
-                "text": text
-            }
-            if keep_extra_json:
-                extra = {}
-                if isinstance(obj.get("meta"), dict) and obj.get("meta"):
-                    extra["meta"] = obj["meta"]
-                if isinstance(obj.get("bearers"), list) and obj.get("bearers"):
-                    extra["bearers"] = obj["bearers"]
-                if extra:
-                    doc_rec["extra_json"] = extra
-
-            docs_out.write(json.dumps(doc_rec, ensure_ascii=False) + "\n")
+            doc_line, ch_lines, n = res
+            docs_out.write(doc_line)
+            ch_out.write(ch_lines)
             total_docs += 1
-
-            # 切分 text -> chunks.jsonl
-            produced = split_text(text)
-            cursor = 0
-            for idx, piece in enumerate(produced):
-                start = text.find(piece, cursor)
-                if start < 0:  # 兜底
-                    start = text.find(piece)
-                end = start + len(piece)
-                cursor = max(cursor, end)
-                ch_rec = {
-                    "document_id": doc_id,
-                    "chunk_index": idx,
-                    "content": piece,
-                    "char_start": start,
-                    "char_end": end
-                }
-                ch_out.write(json.dumps(ch_rec, ensure_ascii=False) + "\n")
-                total_chunks += 1
+            total_chunks += n
 
     return {
         "input": str(input_path),
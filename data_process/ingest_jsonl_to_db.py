@@ -5,34 +5,33 @@ ingest_jsonl_to_db.py
 ---------------------
 将 JSONL 导入到已存在的 PostgreSQL 表：
   documents(id BIGSERIAL PK, url UNIQUE, title, lang, domain, fetched_at_iso, text, extra_json)
-  chunks(id BIGSERIAL PK, doc_id FK -> documents.id, chunk_index, content, char_start, char_end, token_estimate, content_md5, UNIQUE(doc_id, chunk_index))
+  chunks(id BIGSERIAL PK, doc_id FK -> documents.id, chunk_index, content, char_start, char_end, token_estimate, content_md5 (blake2b-128 hex), UNIQUE(doc_id, chunk_index))
 
 特性：
 - 幂等导入：documents 以 url 唯一；chunks 以 (doc_id, chunk_index) 唯一
 - 可选：若无 chunks.jsonl，则从 documents.text 自动切块后导入（--auto-chunk-*）
 - 不包含“重建表”功能（你已完成重建）
+- 事务：documents 一个事务、chunks 一个事务，各提交一次；出错整段回滚
+- 可选 --cold-load：整批灌 chunks 前把表设为 UNLOGGED 并删掉其二级索引/唯一约束，灌完再重建。
+  这些 DDL 都在 chunks 的事务里，中途失败随回滚一并恢复；期间 chunks 持排他锁，其他会话不可读写。
+  同键重复行在重建前只保留最后写入的一条（chunks.id 会变）
 
 依赖：
-  pip install psycopg2-binary tqdm
+  pip install psycopg2-binary tqdm   # 可选：orjson 加速 JSON 解析/序列化
 环境变量：
   PGHOST / PGPORT / PGUSER / PGPASSWORD / PGDATABASE
 """
 
-import os, json, hashlib, math, datetime, argparse, re
+import io, hashlib, datetime, argparse
 from typing import Optional, List, Tuple
-import psycopg2
-from psycopg2.extras import execute_batch
 from tqdm import tqdm
 
-# -------- 连接 ----------
-def connect():
-    return psycopg2.connect(
-        host=os.environ.get("PGHOST", "localhost"),
-        port=int(os.environ.get("PGPORT", "5432")),
-        user=os.environ.get("PGUSER", "postgres"),
-        password=os.environ.get("PGPASSWORD", ""),
-        dbname=os.environ.get("PGDATABASE", "postgres"),
-    )
+from _text import split_text_with_offsets, stable_id, content_hash, open_jsonl, loads, dumps
+from _pg import connect
+
+# 批大小：大批次摊薄网络往返；每批一次 COPY + 合并，提交按阶段各一次（见 main）
+DOC_BATCH = 5000
+CHUNK_BATCH = 10000
 
 # -------- 助手 ----------
 def ensure_url(url: Optional[str], title: str, text: str) -> str:
@@ -53,53 +52,49 @@ def to_iso(val) -> Optional[str]:
         s = str(val).strip()
         return s or None
 
-def est_tokens_by_chars(s: str) -> int:
-    # 简单估计：~4 chars / token
-    return max(1, math.ceil(len(s) / 4))
+def est_tokens_by_bytes(b: bytes) -> int:
+    # 简单估计：~4 UTF-8 字节 / token（中文一字 3 字节，比按字符数估计更接近实际）
+    return max(1, -(-len(b) // 4))
 
-# 简单中文断句切块（可按需替换为更精细的 token 切块）
-SPLIT_PAT = re.compile(r"(?:\n{2,}|。|；|！|\?|？)")
-def split_text(text: str, max_chars=1000, min_chars=600) -> List[str]:
-    if not text:
-        return []
-    parts = [p.strip() for p in SPLIT_PAT.split(text) if p.strip()]
-    chunks, buf = [], ""
-    for p in parts:
-        if len(buf) + len(p) + 1 <= max_chars:
-            buf = (buf + " " + p).strip() if buf else p
-        else:
-            if buf: chunks.append(buf)
-            buf = p
-    if buf: chunks.append(buf)
-    # 合并过短块
-    merged = []
-    for c in chunks:
-        if merged and len(c) < min_chars and len(merged[-1]) + len(c) + 1 <= int(max_chars*1.5):
-            merged[-1] = (merged[-1] + " " + c).strip()
-        else:
-            merged.append(c)
-    return merged
+# -------- COPY 暂存 ----------
+# 批量数据先 COPY FROM STDIN 进临时暂存表，再一条 INSERT ... SELECT ... ON CONFLICT 合并进正式表，
+# 绕开逐行 Parse/Bind 的协议开销。暂存表 ON COMMIT DROP，只活在当前事务里。
+# 转义在 UTF-8 bytes 上做：bytes.replace 比 str.translate 处理中文快一个数量级，且 bytes 直接就是 COPY 载荷
+def _copy_field(v) -> bytes:
+    if v is None:
+        return b"\\N"
+    if not isinstance(v, bytes):
+        v = str(v).encode("utf-8")
+    return v.replace(b"\\", b"\\\\").replace(b"\t", b"\\t").replace(b"\n", b"\\n").replace(b"\r", b"\\r")
+
+def copy_rows(cur, table: str, columns: Tuple[str, ...], rows: list):
+    """把 rows 按 COPY text 格式（TSV，\\N 表示 NULL）写入 table。
+    载荷是 UTF-8 字节，显式声明 ENCODING，不受连接 client_encoding 影响。"""
+    buf = io.BytesIO()
+    for r in rows:
+        buf.write(b"\t".join(map(_copy_field, r)))
+        buf.write(b"\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT text, ENCODING 'UTF8')", buf)
 
 # -------- documents upsert ----------
-DOCS_SQL_WITH_ID = """
-INSERT INTO documents
-(id, url, domain, fetched_at_iso, title, lang, text, extra_json, created_at, updated_at)
-VALUES (%s, %s, %s, %s, %s, %s, %s, %s, now(), now())
-ON CONFLICT (url) DO UPDATE SET
-  domain         = EXCLUDED.domain,
-  fetched_at_iso = EXCLUDED.fetched_at_iso,
-  title          = EXCLUDED.title,
-  lang           = EXCLUDED.lang,
-  text           = EXCLUDED.text,
-  extra_json     = COALESCE(EXCLUDED.extra_json, documents.extra_json),
-  updated_at     = now()
-RETURNING id;
+DOC_STAGE_DDL = """
+CREATE TEMP TABLE documents_stage (
+  seq            BIGSERIAL,
+  id             BIGINT,
+  url            TEXT,
+  domain         TEXT,
+  fetched_at_iso TIMESTAMP,
+  title          TEXT,
+  lang           TEXT,
+  text           TEXT,
+  extra_json     JSONB
+) ON COMMIT DROP;
 """
+DOC_STAGE_COLS = ("id", "url", "domain", "fetched_at_iso", "title", "lang", "text", "extra_json")
 
-DOCS_SQL_AUTO_ID = """
-INSERT INTO documents
-(url, domain, fetched_at_iso, title, lang, text, extra_json, created_at, updated_at)
-VALUES (%s, %s, %s, %s, %s, %s, %s, now(), now())
+# 同一批里同一 url 只取最后一条（ON CONFLICT DO UPDATE 不能在一条语句里两次命中同一行）
+_DOCS_UPDATE = """
 ON CONFLICT (url) DO UPDATE SET
   domain         = EXCLUDED.domain,
   fetched_at_iso = EXCLUDED.fetched_at_iso,
@@ -108,13 +103,22 @@ ON CONFLICT (url) DO UPDATE SET
   text           = EXCLUDED.text,
   extra_json     = COALESCE(EXCLUDED.extra_json, documents.extra_json),
   updated_at     = now()
-RETURNING id;
+RETURNING url, id;
 """
 
-def upsert_document(cur, rec: dict) -> int:
+DOCS_MERGE = """
+INSERT INTO documents
+(id, url, domain, fetched_at_iso, title, lang, text, extra_json, created_at, updated_at)
+SELECT DISTINCT ON (url) id, url, domain, fetched_at_iso, title, lang, text, extra_json, now(), now()
+FROM documents_stage
+ORDER BY url, seq DESC
+""" + _DOCS_UPDATE
+
+def document_row(rec: dict) -> tuple:
     """
-    优先使用 JSON 里的 id 写入 documents.id，保证与 chunks.jsonl 对齐。
-    若文件没有 id，才走自增 id 的分支。
+    JSON 记录 -> documents 暂存行。
+    新文档的 documents.id 由 stable_id 在本地确定（有 id 用 id，否则 hash url）；
+    url 已在库里时保留原 id，实际 id 以合并语句 RETURNING 回来的为准。
     """
     url   = ensure_url(rec.get("url"), rec.get("title") or "", rec.get("text") or "")
     domain= rec.get("domain")
@@ -124,23 +128,44 @@ def upsert_document(cur, rec: dict) -> int:
     text  = rec.get("text") or ""
     extra = rec.get("extra_json")
 
-    extra_json = json.dumps(extra, ensure_ascii=False) if extra is not None else None
+    extra_json = dumps(extra) if extra is not None else None  # UTF-8 bytes，直接作 COPY 载荷
 
-    # 是否有传入 id
-    rid = rec.get("id")
-    if rid is not None and str(rid).strip() != "":
-        rid = int(rid)
-        cur.execute(DOCS_SQL_WITH_ID, (rid, url, domain, fetched_at_iso, title, lang, text, extra_json))
-    else:
-        cur.execute(DOCS_SQL_AUTO_ID, (url, domain, fetched_at_iso, title, lang, text, extra_json))
+    return (stable_id(rec), url, domain, fetched_at_iso, title, lang, text, extra_json)
 
-    return cur.fetchone()[0]
+def bulk_upsert_documents(cur, rows: list, url2id: dict):
+    """COPY 暂存 + 合并；每批一个 RETURNING 结果集，把库里实际的 url -> id 记进 url2id。"""
+    if not rows: return
+    cur.execute(DOC_STAGE_DDL)
+    copy_rows(cur, "documents_stage", DOC_STAGE_COLS, rows)
+    cur.execute(DOCS_MERGE)
+    url2id.update(cur.fetchall())
+    cur.execute("DROP TABLE documents_stage;")
 
 # -------- chunks upsert ----------
-CHUNK_UPSERT = """
+CHUNK_STAGE_DDL = """
+CREATE TEMP TABLE chunks_stage (
+  seq            BIGSERIAL,
+  doc_id         BIGINT,
+  chunk_index    INTEGER,
+  content        TEXT,
+  char_start     INTEGER,
+  char_end       INTEGER,
+  token_estimate INTEGER,
+  content_md5    TEXT
+) ON COMMIT DROP;
+"""
+CHUNK_STAGE_COLS = ("doc_id", "chunk_index", "content", "char_start", "char_end", "token_estimate", "content_md5")
+
+# 同键只留最后一条，与逐行 upsert 的结果一致；冷加载时没有唯一约束，只能用不带 ON CONFLICT 的 CHUNK_INSERT
+CHUNK_INSERT = """
 INSERT INTO chunks
 (doc_id, chunk_index, content, char_start, char_end, token_estimate, content_md5, created_at, updated_at)
-VALUES (%s,%s,%s,%s,%s,%s,%s, now(), now())
+SELECT DISTINCT ON (doc_id, chunk_index)
+  doc_id, chunk_index, content, char_start, char_end, token_estimate, content_md5, now(), now()
+FROM chunks_stage
+ORDER BY doc_id, chunk_index, seq DESC
+"""
+CHUNK_MERGE = CHUNK_INSERT + """
 ON CONFLICT (doc_id, chunk_index) DO UPDATE SET
   content        = EXCLUDED.content,
   char_start     = EXCLUDED.char_start,
@@ -150,62 +175,98 @@ ON CONFLICT (doc_id, chunk_index) DO UPDATE SET
   updated_at     = now();
 """
 
-def bulk_upsert_chunks(cur, rows: list):
+def bulk_upsert_chunks(cur, rows: list, cold: bool = False):
     if not rows: return 0
-    execute_batch(cur, CHUNK_UPSERT, rows, page_size=500)
-    return len(rows)
+    cur.execute(CHUNK_STAGE_DDL)
+    copy_rows(cur, "chunks_stage", CHUNK_STAGE_COLS, rows)
+    cur.execute(CHUNK_INSERT if cold else CHUNK_MERGE)
+    n = cur.rowcount
+    cur.execute("DROP TABLE chunks_stage;")
+    return n
+
+# -------- 冷加载 ----------
+# chunks 除主键外的索引；挂在约束上的（UNIQUE）要按约束删/建，其余按索引删/建
+CHUNK_INDEX_DDL_SQL = """
+SELECT COALESCE('ALTER TABLE chunks ADD CONSTRAINT ' || quote_ident(c.conname) || ' ' || pg_get_constraintdef(c.oid),
+                pg_get_indexdef(i.indexrelid)),
+       COALESCE('ALTER TABLE chunks DROP CONSTRAINT ' || quote_ident(c.conname),
+                'DROP INDEX ' || i.indexrelid::regclass::text)
+FROM pg_index i
+LEFT JOIN pg_constraint c ON c.conindid = i.indexrelid AND c.conrelid = i.indrelid
+WHERE i.indrelid = 'chunks'::regclass AND NOT i.indisprimary;
+"""
+
+# 重建唯一约束前去掉同键旧行，只留最后写入（id 最大）的一条，与 upsert 的“后写覆盖”一致
+CHUNK_DEDUPE = """
+DELETE FROM chunks a USING chunks b
+WHERE a.doc_id = b.doc_id AND a.chunk_index = b.chunk_index AND a.id < b.id;
+"""
+
+def begin_cold_load(cur) -> List[str]:
+    """记录并删除 chunks 的二级索引/唯一约束，表设为 UNLOGGED；返回重建用的 DDL。"""
+    cur.execute(CHUNK_INDEX_DDL_SQL)
+    ddl = cur.fetchall()
+    for _, drop in ddl:
+        cur.execute(drop)
+    cur.execute("ALTER TABLE chunks SET UNLOGGED;")
+    return [create for create, _ in ddl]
+
+def end_cold_load(cur, ddl: List[str]):
+    """去重后重建索引/约束，表恢复为 LOGGED。"""
+    cur.execute(CHUNK_DEDUPE)
+    for create in ddl:
+        cur.execute(create)
+    cur.execute("ALTER TABLE chunks SET LOGGED;")
+    cur.execute("ANALYZE chunks;")
 
-def ingest_chunks_from_file(cur, path: str, url2id: dict) -> int:
-    """从 chunks.jsonl 导入：字段为 document_id/chunk_index/content/char_start/char_end"""
+def ingest_chunks_from_file(cur, path: str, url2id: dict, cold: bool = False, use_mmap: bool = False) -> int:
+    """
+    从 chunks.jsonl 导入：字段为 document_id/chunk_index/content/char_start/char_end
+    document_id 是 url 时按 url2id（本次导入文档在库里的实际 id）解析，查不到的跳过。
+    """
     total = 0
     batch = []
-    with open(path, "r", encoding="utf-8") as f:
+    with open_jsonl(path, use_mmap) as f:
         for line in tqdm(f, desc="Import chunks.jsonl"):
-            line = line.strip()
-            if not line:
+            if line.isspace():  # isspace 遇到首个非空白字节即返回，不像 strip 那样每行复制一份；行尾换行交给 loads 忽略
                 continue
-            obj = json.loads(line)
+            obj = loads(line)
             doc_id = obj.get("document_id") or obj.get("doc_id")
             if isinstance(doc_id, str) and doc_id.startswith("http"):
                 doc_id = url2id.get(doc_id)
             if not doc_id:
                 continue
-            content = obj.get("content") or ""
+            content = (obj.get("content") or "").encode("utf-8")  # 编码一次，哈希/估算/COPY 共用
             cstart  = obj.get("char_start")
             cend    = obj.get("char_end")
-            token_est = est_tokens_by_chars(content)
-            md5 = hashlib.md5(content.encode("utf-8")).hexdigest()
-            batch.append((int(doc_id), int(obj.get("chunk_index", 0)), content, cstart, cend, token_est, md5))
-            if len(batch) >= 2000:
-                total += bulk_upsert_chunks(cur, batch); batch = []
+            token_est = est_tokens_by_bytes(content)
+            h = content_hash(content)
+            batch.append((int(doc_id), int(obj.get("chunk_index", 0)), content, cstart, cend, token_est, h))
+            if len(batch) >= CHUNK_BATCH:
+                total += bulk_upsert_chunks(cur, batch, cold); batch = []
     if batch:
-        total += bulk_upsert_chunks(cur, batch)
+        total += bulk_upsert_chunks(cur, batch, cold)
     return total
 
-def auto_chunk_all(cur, max_chars=1000, overlap=100) -> int:
+def auto_chunk_all(cur, max_chars=1000, overlap=100, cold: bool = False) -> int:
     """从 documents.text 自动切块入 chunks（按已存在 documents 全量）"""
     total = 0
-    cur2 = cur.connection.cursor()
+    # 服务端命名游标：按 itersize 分批取回，内存只占一批文档而不是全库正文
+    cur2 = cur.connection.cursor(name="doc_stream")
+    cur2.itersize = 1000
     cur2.execute("SELECT id, text FROM documents WHERE text IS NOT NULL;")
-    rows = cur2.fetchall()
     batch = []
-    for doc_id, text in tqdm(rows, desc="Auto chunking from documents"):
+    for doc_id, text in tqdm(cur2, desc="Auto chunking from documents"):
         if not text: continue
-        pieces = split_text(text, max_chars=max_chars, min_chars=max_chars//2)
-        cursor = 0
-        for idx, piece in enumerate(pieces):
-            start = text.find(piece, cursor)
-            if start < 0:
-                start = text.find(piece)
-            end = start + len(piece)
-            cursor = max(cursor, end)
-            token_est = est_tokens_by_chars(piece)
-            md5 = hashlib.md5(piece.encode("utf-8")).hexdigest()
-            batch.append((doc_id, idx, piece, start, end, token_est, md5))
-            if len(batch) >= 2000:
-                total += bulk_upsert_chunks(cur, batch); batch = []
+        pieces = split_text_with_offsets(text, max_chars=max_chars, min_chars=max_chars//2)
+        for idx, (piece, start, end) in enumerate(pieces):
+            b = piece.encode("utf-8")  # 编码一次，哈希/估算/COPY 共用
+            batch.append((doc_id, idx, b, start, end, est_tokens_by_bytes(b), content_hash(b)))
+            if len(batch) >= CHUNK_BATCH:
+                total += bulk_upsert_chunks(cur, batch, cold); batch = []
     if batch:
-        total += bulk_upsert_chunks(cur, batch)
+        total += bulk_upsert_chunks(cur, batch, cold)
+    cur2.close()
     return total
 
 # -------- main ----------
@@ -214,52 +275,57 @@ def main():
     ap.add_argument("--docs", required=True, help="Path to documents_min.jsonl")
     ap.add_argument("--chunks", default=None, help="Optional: chunks.jsonl (if omitted, will auto-chunk from documents)")
     ap.add_argument("--auto-chunk-size", type=int, default=1000, help="Auto chunk size in chars when --chunks is not provided")
+    ap.add_argument("--mmap", action="store_true", help="Read JSONL inputs through mmap instead of buffered reads")
+    ap.add_argument("--cold-load", action="store_true", help="Bulk-load chunks as UNLOGGED without indexes, then rebuild them (locks chunks for the whole load)")
     args = ap.parse_args()
 
     conn = connect()
-    conn.autocommit = False
     cur = conn.cursor()
 
-    # 1) 导入 documents
-    print(f"[*] Import documents from: {args.docs}")
-    url2id = {}
-    docs_cnt = 0
-    with open(args.docs, "r", encoding="utf-8") as f:
-        for line in tqdm(f, desc="Upsert documents"):
-            line = line.strip()
-            if not line: continue
-            try:
-                rec = json.loads(line)
-            except Exception:
-                continue
-            doc_id = upsert_document(cur, rec)
-            docs_cnt += 1
-            if rec.get("url"):
-                url2id[rec["url"]] = doc_id
-            if docs_cnt % 500 == 0:
-                conn.commit()
-    conn.commit()
-    print(f"[+] documents upserted: {docs_cnt}")
-
-    cur.execute("""
-      SELECT setval(pg_get_serial_sequence('documents','id'), COALESCE((SELECT MAX(id) FROM documents), 0));
-    """)
-    conn.commit()
-
-    # 2) 导入 chunks（来自文件，或自动从 documents.text 生成）
-    if args.chunks:
-        print(f"[*] Import chunks from: {args.chunks}")
-        ch_cnt = ingest_chunks_from_file(cur, args.chunks, url2id)
+    try:
+        # 1) 导入 documents（整段一个事务）
+        print(f"[*] Import documents from: {args.docs}")
+        docs_cnt = 0
+        batch = []
+        url2id = {}  # url -> 库里实际的 documents.id，供 chunks 文件按 url 引用时解析
+        with open_jsonl(args.docs, args.mmap) as f:
+            for line in tqdm(f, desc="Upsert documents"):
+                if line.isspace(): continue
+                try:
+                    rec = loads(line)
+                except Exception:
+                    continue
+                batch.append(document_row(rec))
+                docs_cnt += 1
+                if len(batch) >= DOC_BATCH:
+                    bulk_upsert_documents(cur, batch, url2id); batch = []
+        bulk_upsert_documents(cur, batch, url2id)
+        cur.execute("""
+          SELECT setval(pg_get_serial_sequence('documents','id'), COALESCE((SELECT MAX(id) FROM documents), 0));
+        """)
         conn.commit()
-        print(f"[+] chunks upserted: {ch_cnt}")
-    else:
-        print(f"[*] Auto-chunk from documents (size={args.auto_chunk_size})")
-        ch_cnt = auto_chunk_all(cur, max_chars=args.auto_chunk_size)
+        print(f"[+] documents upserted: {docs_cnt}")
+
+        # 2) 导入 chunks（来自文件，或自动从 documents.text 生成；整段一个事务）
+        if args.cold_load:
+            ddl = begin_cold_load(cur)
+        if args.chunks:
+            print(f"[*] Import chunks from: {args.chunks}")
+            ch_cnt = ingest_chunks_from_file(cur, args.chunks, url2id, cold=args.cold_load, use_mmap=args.mmap)
+        else:
+            print(f"[*] Auto-chunk from documents (size={args.auto_chunk_size})")
+            ch_cnt = auto_chunk_all(cur, max_chars=args.auto_chunk_size, cold=args.cold_load)
+        if args.cold_load:
+            print("[*] Rebuild chunks indexes")
+            end_cold_load(cur, ddl)
         conn.commit()
         print(f"[+] chunks upserted: {ch_cnt}")
-
-    cur.close()
-    conn.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
     print("✅ Done.")
 
 if __name__ == "__main__":
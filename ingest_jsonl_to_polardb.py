@@ -1,7 +1,7 @@
 # ingest_jsonl_to_polardb.py
 # ------------------------------------------------------------
 # 用法（Windows PowerShell 示例）：
-#   pip install psycopg2-binary python-dateutil tqdm
+#   pip install psycopg2-binary python-dateutil tqdm   # 可选：orjson 加速 JSON 解析/序列化
 #
 #   $env:PGHOST="nioniedb.rwlb.rds.aliyuncs.com"
 #   $env:PGPORT="5432"
@@ -14,26 +14,39 @@
 # 依赖前提：
 # 1) 已在 PolarDB 执行建表脚本（documents / chunks）
 # 2) 已执行：CREATE EXTENSION IF NOT EXISTS vector;（可选）
+# 3) 与 data_process/ 同在仓库根目录（JSONL 读取、内容哈希、连接从那里导入）
 # ------------------------------------------------------------
 
 import os
-import json
 import argparse
-import math
 import hashlib
 import datetime
 from typing import List, Tuple, Optional
 
-import psycopg2
-from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
 from tqdm import tqdm
 
+from data_process._text import content_hash, open_jsonl, loads, dumps
+from data_process._pg import connect
+
+
+def window_offsets(n: int, size: int, overlap: int) -> range:
+    """
+    长度 n 的文本按 size 切窗、相邻窗口重叠 overlap，返回各窗口起点。
+    起点是等差数列，直接算出最后一个起点（首个使 start + size >= n 的位置），不用逐窗循环推进。
+    """
+    step = size - overlap
+    if step <= 0:
+        raise ValueError(f"overlap ({overlap}) must be smaller than size ({size})")
+    last = -(-max(0, n - size) // step) * step
+    return range(0, min(last + 1, n), step)
+
 
 def make_chunks(text: Optional[str], size: int = 1000, overlap: int = 100) -> List[Tuple[int, int, str, int, str]]:
     """
     将长文本切块：
-    返回列表元素为 (char_start, char_end, chunk_text, token_estimate, md5)
-    token_estimate 采用 len(chars)/4 的粗略估计，便于后续控制向量化成本。
+    返回列表元素为 (char_start, char_end, chunk_text, token_estimate, content_hash)
+    token_estimate 采用 UTF-8 字节数/4 的粗略估计，便于后续控制向量化成本。
     """
     if not text:
         return []
@@ -41,34 +54,16 @@ def make_chunks(text: Optional[str], size: int = 1000, overlap: int = 100) -> Li
     n = len(text)
     if n == 0:
         return []
-    chunks = []
-    start = 0
-    while start < n:
+    starts = window_offsets(n, size, overlap)
+    chunks = [None] * len(starts)  # 窗口数已知，一次分配到位
+    for i, start in enumerate(starts):
         end = min(start + size, n)
         chunk = text[start:end]
-        token_est = max(1, math.ceil(len(chunk) / 4))
-        md5 = hashlib.md5(chunk.encode("utf-8")).hexdigest()
-        chunks.append((start, end, chunk, token_est, md5))
-        if end == n:
-            break
-        # 产生重叠
-        start = max(0, end - overlap)
+        b = chunk.encode("utf-8")  # 编码一次，哈希与估算共用
+        chunks[i] = (start, end, chunk, max(1, -(-len(b) // 4)), content_hash(b))
     return chunks
 
 
-def connect():
-    """使用环境变量建立数据库连接。"""
-    conn = psycopg2.connect(
-        host=os.environ.get("PGHOST", "localhost"),
-        port=int(os.environ.get("PGPORT", "5432")),
-        user=os.environ.get("PGUSER", "postgres"),
-        password=os.environ.get("PGPASSWORD", ""),
-        dbname=os.environ.get("PGDATABASE", "postgres"),
-    )
-    conn.autocommit = False
-    return conn
-
-
 def to_iso_from_unix(ts) -> Optional[str]:
     """将 Unix 时间戳（秒）转为 ISO 字符串，失败则返回 None。"""
     try:
@@ -96,93 +91,151 @@ def ensure_url(obj: dict) -> str:
     return f"missing://{md5}"
 
 
-def upsert_document(cur, obj) -> int:
+DOC_BATCH = 500  # 每批 upsert 的文档数，一条语句 + 一个保存点；整个导入最后只提交一次
+
+DOCS_UPSERT_SQL = """
+    INSERT INTO documents
+    (url, domain, fetched_at, fetched_at_iso, status, content_type, title, lang, text, raw_html, extra_json, created_at, updated_at)
+    VALUES %s
+    ON CONFLICT (url) DO UPDATE SET
+        domain = EXCLUDED.domain,
+        fetched_at = EXCLUDED.fetched_at,
+        fetched_at_iso = EXCLUDED.fetched_at_iso,
+        status = EXCLUDED.status,
+        content_type = EXCLUDED.content_type,
+        title = EXCLUDED.title,
+        lang = EXCLUDED.lang,
+        text = EXCLUDED.text,
+        raw_html = EXCLUDED.raw_html,
+        extra_json = EXCLUDED.extra_json,
+        updated_at = now()
+    RETURNING url, id;
+"""
+DOCS_UPSERT_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s::jsonb, now(), now())"
+
+
+def document_params(obj) -> tuple:
     """
-    将一条 JSON 对象写入 documents 并返回 doc_id。
-    若 url 冲突则更新；保留 extra_json 以存储未显式建表的字段。
+    将一条 JSON 对象转为 documents 一行的参数。
+    保留 extra_json 以存储未显式建表的字段。
     """
-    url = ensure_url(obj)
-    domain = obj.get("domain")
     fetched_at = obj.get("fetched_at")
-    fetched_at_iso = to_iso_from_unix(fetched_at)
-
-    status = obj.get("status")
-    content_type = obj.get("content_type")
-    title = obj.get("title")
-    lang = obj.get("lang")
-    text = obj.get("text")
-    raw_html = obj.get("html") or obj.get("raw_html")
-
     known = {"url", "domain", "fetched_at", "status", "content_type", "title", "lang", "text", "html", "raw_html"}
     extra = {k: v for k, v in obj.items() if k not in known} or None
+    return (
+        ensure_url(obj),
+        obj.get("domain"),
+        fetched_at,
+        to_iso_from_unix(fetched_at),
+        obj.get("status"),
+        obj.get("content_type"),
+        obj.get("title"),
+        obj.get("lang"),
+        obj.get("text"),
+        obj.get("html") or obj.get("raw_html"),
+        # psycopg2 会把 bytes 当 bytea 传，jsonb 列只能给 str
+        dumps(extra).decode("utf-8"),
+    )
 
-    cur.execute(
-        """
-        INSERT INTO documents
-        (url, domain, fetched_at, fetched_at_iso, status, content_type, title, lang, text, raw_html, extra_json, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, to_jsonb(%s::json), now(), now())
-        ON CONFLICT (url) DO UPDATE SET
-            domain = EXCLUDED.domain,
-            fetched_at = EXCLUDED.fetched_at,
-            fetched_at_iso = EXCLUDED.fetched_at_iso,
-            status = EXCLUDED.status,
-            content_type = EXCLUDED.content_type,
-            title = EXCLUDED.title,
-            lang = EXCLUDED.lang,
-            text = EXCLUDED.text,
-            raw_html = EXCLUDED.raw_html,
-            extra_json = EXCLUDED.extra_json,
-            updated_at = now()
-        RETURNING id;
-        """,
-        (
-            url,
-            domain,
-            fetched_at,
-            fetched_at_iso,
-            status,
-            content_type,
-            title,
-            lang,
-            text,
-            raw_html,
-            json.dumps(extra, ensure_ascii=False),
-        ),
+
+def upsert_documents(cur, objs) -> List[int]:
+    """
+    批量写入 documents，按输入顺序返回各条的 doc_id。
+    若 url 冲突则更新。同一批内重复的 url 只保留最后一条
+    （与逐条 upsert 的最终结果一致，且避免 ON CONFLICT 同一行更新两次报错）。
+    """
+    by_url = {}
+    for obj in objs:
+        params = document_params(obj)
+        by_url[params[0]] = params
+    rows = execute_values(
+        cur, DOCS_UPSERT_SQL, list(by_url.values()),
+        template=DOCS_UPSERT_TEMPLATE, page_size=DOC_BATCH, fetch=True,
     )
-    doc_id = cur.fetchone()[0]
-    return doc_id
+    url2id = dict(rows)
+    return [url2id[ensure_url(obj)] for obj in objs]
 
 
-def insert_chunks(cur, doc_id: int, base_text: Optional[str], size: int, overlap: int) -> int:
-    """将文本切块写入 chunks 表。"""
+def chunk_rows(doc_id: int, base_text: Optional[str], size: int, overlap: int) -> list:
+    """将文本切块为 chunks 表的行。"""
     rows = []
     if base_text:
-        for idx, (start, end, chunk, token_est, md5) in enumerate(make_chunks(base_text, size=size, overlap=overlap)):
-            rows.append((doc_id, idx, chunk, start, end, token_est, md5))
+        for idx, (start, end, chunk, token_est, h) in enumerate(make_chunks(base_text, size=size, overlap=overlap)):
+            rows.append((doc_id, idx, chunk, start, end, token_est, h))
+    return rows
 
+
+def insert_chunk_rows(cur, rows) -> int:
+    """将切块行写入 chunks 表。"""
     if not rows:
         return 0
 
-    execute_batch(
+    # 单条多行 INSERT ... VALUES (...),(...)，减少与服务器的往返
+    execute_values(
         cur,
         """
         INSERT INTO chunks
         (doc_id, chunk_index, content, char_start, char_end, token_estimate, content_md5, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+        VALUES %s
         ON CONFLICT DO NOTHING
         """,
         rows,
-        page_size=500,
+        template="(%s, %s, %s, %s, %s, %s, %s, now())",
+        page_size=5000,
     )
     return len(rows)
 
 
+def import_batch(cur, objs, size: int, overlap: int) -> Tuple[int, int]:
+    """写入一批文档及其切块，返回 (docs, chunks)。"""
+    rows = []
+    for obj, doc_id in zip(objs, upsert_documents(cur, objs)):
+        # Prefer plain text; fallback to html/raw_html if no text
+        base_text = obj.get("text") or obj.get("html") or obj.get("raw_html")
+        rows.extend(chunk_rows(doc_id, base_text, size, overlap))
+    return len(objs), insert_chunk_rows(cur, rows)
+
+
+def try_import(cur, objs, size: int, overlap: int) -> Optional[Tuple[int, int]]:
+    """在保存点内写入一批；出错只回滚到保存点（不影响整个事务）并返回 None。"""
+    cur.execute("SAVEPOINT import_batch")
+    try:
+        res = import_batch(cur, objs, size, overlap)
+    except Exception:
+        cur.execute("ROLLBACK TO SAVEPOINT import_batch")
+        return None
+    cur.execute("RELEASE SAVEPOINT import_batch")
+    return res
+
+
+def flush_batch(cur, objs, size: int, overlap: int) -> Tuple[int, int, int]:
+    """
+    写入一批，返回 (docs, chunks, bad)。
+    整批失败时回到保存点逐条重试，只把真正出错的行记为 bad。
+    """
+    res = try_import(cur, objs, size, overlap)
+    if res is not None:
+        return res[0], res[1], 0
+    docs = chunks = bad = 0
+    for obj in objs:
+        res = try_import(cur, [obj], size, overlap)
+        if res is None:
+            bad += 1
+            continue
+        docs += res[0]
+        chunks += res[1]
+    return docs, chunks, bad
+
+
 def main():
     ap = argparse.ArgumentParser(description="Import JSONL into PolarDB (documents + chunks).")
     ap.add_argument("--jsonl", required=True, help="Path to the JSONL file.")
     ap.add_argument("--chunk-size", type=int, default=1000, help="Chunk size in characters (default: 1000).")
     ap.add_argument("--overlap", type=int, default=100, help="Overlap between chunks in characters (default: 100).")
+    ap.add_argument("--mmap", action="store_true", help="Read the JSONL through mmap instead of buffered reads.")
     args = ap.parse_args()
+    if args.overlap >= args.chunk_size:
+        ap.error("--overlap must be smaller than --chunk-size")
 
     if not os.path.exists(args.jsonl):
         raise FileNotFoundError(f"JSONL not found: {args.jsonl}")
@@ -193,45 +246,41 @@ def main():
     inserted_docs = 0
     inserted_chunks = 0
     bad_lines = 0
+    batch = []
 
-    with open(args.jsonl, "r", encoding="utf-8") as f:
-        for line in tqdm(f, desc="Importing"):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-            except Exception:
-                bad_lines += 1
-                continue
-
-            # Upsert document
-            try:
-                doc_id = upsert_document(cur, obj)
-            except Exception as e:
-                conn.rollback()
-                bad_lines += 1
-                continue
-
-            # Prefer plain text; fallback to html/raw_html if no text
-            base_text = obj.get("text") or obj.get("html") or obj.get("raw_html")
-
-            try:
-                c = insert_chunks(cur, doc_id, base_text, args.chunk_size, args.overlap)
-            except Exception:
-                conn.rollback()
-                bad_lines += 1
-                continue
-
-            inserted_docs += 1
+    # 整个导入一个事务、最后提交一次；坏行靠保存点隔离，其余异常整体回滚
+    try:
+        with open_jsonl(args.jsonl, args.mmap) as f:
+            for line in tqdm(f, desc="Importing"):
+                if line.isspace():  # 空白行跳过；不 strip，orjson 本身容忍行尾换行
+                    continue
+                try:
+                    obj = loads(line)
+                except Exception:
+                    bad_lines += 1
+                    continue
+
+                batch.append(obj)
+                if len(batch) >= DOC_BATCH:
+                    d, c, bad = flush_batch(cur, batch, args.chunk_size, args.overlap)
+                    inserted_docs += d
+                    inserted_chunks += c
+                    bad_lines += bad
+                    batch = []
+
+        if batch:
+            d, c, bad = flush_batch(cur, batch, args.chunk_size, args.overlap)
+            inserted_docs += d
             inserted_chunks += c
+            bad_lines += bad
 
-            if inserted_docs % 100 == 0:
-                conn.commit()
-
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
 
     print(f"✅ Done. docs={inserted_docs}, chunks={inserted_chunks}, bad_lines={bad_lines}")
 
@@ -1,11 +1,13 @@
 from scrapy import cmdline
 
-cmdline.execute([
-    "scrapy", "crawl", "focused",
-    "-a", "start=23535",
-    "-a", "end=23756",
-    "-a", "enrich_mode=append",          # 保留正文并追加结构化块
-    "-a", "enrich_format=readable",      # 可读文本块
-    "-a", "add_json_summary=1",          # 末尾再加 JSON 摘要（可选）
-])
+if __name__ == "__main__":
+    # 进程池用 spawn 启动 worker 时会重新导入主模块，必须有这层保护
+    cmdline.execute([
+        "scrapy", "crawl", "focused",
+        "-a", "start=23535",
+        "-a", "end=23756",
+        "-a", "enrich_mode=append",          # 保留正文并追加结构化块
+        "-a", "enrich_format=readable",      # 可读文本块
+        "-a", "add_json_summary=1",          # 末尾再加 JSON 摘要（可选）
+    ])
 